@@ -8,20 +8,26 @@ from datetime import datetime
 from pathlib import Path
 from typing import Literal
 
-import duckdb
 from dotenv import load_dotenv
 
 from shelf import steps
 from shelf.core import Shelf
 from shelf.exceptions import StepDefinitionError
-from shelf.snapshots import Snapshot
+from shelf.paths import TABLE_DIR
+from shelf.snapshots import Snapshot, open_in_editor
 from shelf.types import StepURI
 from shelf.utils import add_to_gitignore, checksum_manifest, console
 
 load_dotenv()
 
 
-BLACKLIST = [".DS_Store"]
+VERSION_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+VERSION_LENGTH = len("YYYY-MM-DD")
+
+EXPORT_META_TABLE = "_shelf_export_meta"
+
+# maps step paths to table names in a single pass
+SNAKE_TRANSLATION = str.maketrans({"/": "_", "-": None})
 
 
 def main():
@@ -72,6 +78,12 @@ def main():
         action="store_true",
         help="Don't execute, just print the steps that would be executed",
     )
+    run_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=_positive_int,
+        help="How many steps to run at once (defaults to the number of CPUs)",
+    )
 
     list_parser = subparsers.add_parser(
         "list", help="List all datasets in alphabetical order"
@@ -153,7 +165,11 @@ def main():
 
     if args.command == "snapshot":
         snapshot_to_shelf(
-            Path(args.file_path), args.dataset_name, edit=args.edit, force=args.force
+            Path(args.file_path),
+            args.dataset_name,
+            edit=args.edit,
+            force=args.force,
+            shelf=shelf,
         )
         return
 
@@ -161,7 +177,7 @@ def main():
         return list_steps_cmd(shelf, args.regex, args.paths)
 
     elif args.command == "run":
-        return plan_and_run(shelf, args.path, args.force, args.dry_run)
+        return plan_and_run(shelf, args.path, args.force, args.dry_run, args.jobs)
 
     elif args.command == "audit":
         return audit_shelf(shelf, args.fix)
@@ -186,15 +202,22 @@ def init_shelf() -> None:
 
 
 def snapshot_to_shelf(
-    file_path: Path, dataset_name: str, edit: bool = False, force: bool = False
+    file_path: Path,
+    dataset_name: str,
+    edit: bool = False,
+    force: bool = False,
+    shelf: Shelf | None = None,
 ) -> Snapshot:
     _check_s3_credentials()
 
     # ensure we are tagging a version on everything
     dataset_name = _maybe_add_version(dataset_name)
 
+    # reuse the caller's shelf rather than parsing shelf.yaml again
+    if shelf is None:
+        shelf = Shelf()
+
     # sanity check that it does not exist
-    shelf = Shelf()
     proposed_uri = StepURI("snapshot", dataset_name)
     if proposed_uri in shelf.steps and not force:
         raise ValueError(f"Dataset already exists in shelf: {proposed_uri}")
@@ -213,7 +236,7 @@ def snapshot_to_shelf(
     add_to_gitignore(snapshot.path)
 
     if edit:
-        subprocess.run(["vim", snapshot.metadata_path])
+        open_in_editor(snapshot.metadata_path)
 
     shelf.steps[proposed_uri] = []
     shelf.save()
@@ -229,22 +252,38 @@ def list_steps_cmd(shelf: Shelf, regex: str | None = None, paths: bool = False)
 def list_steps(
     shelf: Shelf, regex: str | None = None, paths: bool = False
 ) -> list[Path] | list[StepURI]:
-    steps = sorted(shelf.steps)
-
+    # filter before sorting, so that we only sort what we return
+    matches = iter(shelf.steps)
     if regex:
-        steps = [s for s in steps if re.search(regex, str(s))]
+        pattern = re.compile(regex)
+        matches = (s for s in matches if pattern.search(s.uri))
+
+    steps = sorted(matches)
 
     if paths:
-        steps = [s.rel_path for s in steps]
+        return [s.rel_path for s in steps]
 
     return steps
 
 
+def _positive_int(value: str) -> int:
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"must be a whole number, got {value!r}")
+
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+
+    return jobs
+
+
 def plan_and_run(
     shelf: Shelf,
     regex: str | None = None,
     force: bool = False,
     dry_run: bool = False,
+    jobs: int | None = None,
 ) -> None:
     # to help unit testing
     shelf.refresh()
@@ -267,7 +306,7 @@ def plan_and_run(
         print("Already up to date!")
         return
 
-    steps.execute_dag(dag, dry_run=dry_run)
+    steps.execute_dag(dag, dry_run=dry_run, jobs=jobs)
 
 
 def resolve_latest(dependencies: list[StepURI], shelf: Shelf) -> list[StepURI]:
@@ -286,28 +325,61 @@ def export_duckdb(shelf: Shelf, db_file: str, short: bool = False) -> None:
     # Ensure all tables are built
     plan_and_run(shelf)
 
+    import duckdb
+
     # Connect to DuckDB
     conn = duckdb.connect(db_file)
 
     tables = _get_tables(shelf)
+
+    # work out the name each table will end up with
+    final_names = {name: name for name in map(_path_to_snake, tables)}
+    if short:
+        for alias, table_name in _table_aliases(tables):
+            final_names[table_name] = _better_alias(alias, final_names[table_name])
+
+    # remember which version of each parquet file we last exported, so that
+    # we only reload the tables that have changed since
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {EXPORT_META_TABLE} ("
+        "table_name VARCHAR PRIMARY KEY, source VARCHAR, mtime_ns BIGINT, size BIGINT)"
+    )
+    exported = {
+        row[0]: tuple(row[1:])
+        for row in conn.execute(f"SELECT * FROM {EXPORT_META_TABLE}").fetchall()
+    }
+    existing = {
+        row[0]
+        for row in conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()
+    }
+
+    statements = []
     for table in tables:
-        table_name = table.replace("/", "_").replace("-", "").rsplit(".", 1)[0]
-        table_path = (Path("data/tables") / table).with_suffix(".parquet")
+        table_name = _path_to_snake(table)
+        final_name = final_names[table_name]
+        table_path = _table_path(table)
+
+        stat = table_path.stat()
+        source = (str(table_path), stat.st_mtime_ns, stat.st_size)
+        if final_name in existing and exported.get(final_name) == source:
+            continue
 
-        conn.execute(
+        statements.append(
             f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM read_parquet('{table_path}')"
         )
+        if final_name != table_name:
+            statements.append(f'DROP TABLE IF EXISTS "{final_name}"')
+            statements.append(f'ALTER TABLE "{table_name}" RENAME TO "{final_name}"')
 
-    if short:
-        best_alias = {}
-        for alias, table_name in _table_aliases(tables):
-            best_alias[table_name] = _better_alias(
-                alias, best_alias.get(table_name, table_name)
-            )
+        statements.append(
+            f"INSERT OR REPLACE INTO {EXPORT_META_TABLE} "
+            f"VALUES ('{final_name}', '{source[0]}', {source[1]}, {source[2]})"
+        )
 
-        for table_name, alias in best_alias.items():
-            conn.execute(f'DROP TABLE IF EXISTS "{alias}"')
-            conn.execute(f'ALTER TABLE "{table_name}" RENAME TO "{alias}"')
+    # send everything as one script in a single transaction, rather than
+    # committing to the catalog once per table
+    if statements:
+        conn.execute("BEGIN; " + "; ".join(statements) + "; COMMIT;")
 
     conn.close()
 
@@ -367,24 +439,13 @@ def execute_query(
     names: Literal["short", "full", "both"] = "both",
     csv: bool = False,
 ) -> None:
-    tables = _get_tables(shelf)
+    import duckdb
 
-    # Create temporary views
+    # Create temporary views, in a single round trip
     conn = duckdb.connect(":memory:")
-    for path in tables:
-        table_name = _path_to_snake(path)
-        table_path = (Path("data/tables") / path).with_suffix(".parquet")
-        conn.execute(
-            f"CREATE VIEW {table_name} AS SELECT * FROM read_parquet('{table_path}')"
-        )
-
-    if names == "both":
-        for alias, table_name in _table_aliases(tables):
-            conn.execute(f'CREATE VIEW "{alias}" AS SELECT * FROM "{table_name}"')
-
-    elif names == "short":
-        for alias, table_name in _table_aliases(tables):
-            conn.execute(f'ALTER VIEW "{table_name}" RENAME TO "{alias}"')
+    view_sql = _view_statements(_get_tables(shelf), names)
+    if view_sql:
+        conn.execute("\n".join(view_sql))
 
     if query.count(" ") == 0:
         # this is a full-table extraction
@@ -404,12 +465,18 @@ def duckdb_shell(shelf: Shelf, names: str = "both") -> None:
     if names not in ("both", "short", "full"):
         raise ValueError("Names parameter must be one of 'short', 'full' or 'both'")
 
-    tables = _get_tables(shelf)
+    sql = "\n\n".join(_view_statements(_get_tables(shelf), names))
+    with tempfile.NamedTemporaryFile("w", suffix=".sql") as f:
+        f.write(sql)
+        f.flush()
+        subprocess.run(f'duckdb -cmd ".read {f.name}"', shell=True)
 
+
+def _view_statements(tables: list[str], names: str) -> list[str]:
     sql_parts: list[str] = []
     for path in tables:
         table_name = _path_to_snake(path)
-        table_path = (Path("data/tables") / path).with_suffix(".parquet")
+        table_path = _table_path(path)
 
         sql_parts.append(
             f"CREATE OR REPLACE VIEW {table_name} AS\nSELECT * FROM read_parquet('{table_path}');"
@@ -421,18 +488,18 @@ def duckdb_shell(shelf: Shelf, names: str = "both") -> None:
                 sql_parts.append(f'ALTER VIEW "{table_name}" RENAME TO "{alias}";')
             elif names == "both":
                 sql_parts.append(
-                    f'CREATE OR REPLACE VIEW "{alias}" AS\nSELECT * FROM {table_name};'
+                    f'CREATE OR REPLACE VIEW "{alias}" AS\nSELECT * FROM "{table_name}";'
                 )
 
-    sql = "\n\n".join(sql_parts)
-    with tempfile.NamedTemporaryFile("w", suffix=".sql") as f:
-        f.write(sql)
-        f.flush()
-        subprocess.run(f'duckdb -cmd ".read {f.name}"', shell=True)
+    return sql_parts
 
 
 def _path_to_snake(path: str) -> str:
-    return path.replace("/", "_").replace("-", "").rsplit(".", 1)[0]
+    return path.translate(SNAKE_TRANSLATION).rsplit(".", 1)[0]
+
+
+def _table_path(path: str) -> Path:
+    return TABLE_DIR / f"{path}.parquet"
 
 
 def _get_tables(shelf: Shelf) -> list[str]:
@@ -506,7 +573,11 @@ def _maybe_add_version(dataset_name: str) -> str:
 
 
 def _is_valid_version(version: str) -> bool:
-    return bool(re.match(r"\d{4}-\d{2}-\d{2}", version)) or version == "latest"
+    if version == "latest":
+        return True
+
+    # most path segments are too short to hold a date, so skip the regex
+    return len(version) >= VERSION_LENGTH and bool(VERSION_PATTERN.match(version))
 
 
 def _check_s3_credentials() -> None:
@@ -1,14 +1,16 @@
+import os
 from dataclasses import dataclass, field
 from pathlib import Path
 
-import jsonschema
-
-from shelf.schemas import SHELF_SCHEMA
+from shelf.schemas import SHELF_VALIDATOR, validate
 from shelf.types import Dag, StepURI
-from shelf.utils import load_yaml, save_yaml
+from shelf.utils import FileFingerprint, file_fingerprint, load_yaml, save_yaml
 
 DEFAULT_SHELF_PATH = Path("shelf.yaml")
 
+# parsed shelf files, shared by every Shelf in the process
+_parsed_shelves: dict[str, tuple[FileFingerprint, int, Dag]] = {}
+
 
 @dataclass
 class Shelf:
@@ -25,8 +27,19 @@ class Shelf:
         self.refresh()
 
     def refresh(self) -> None:
+        key = os.path.abspath(self.config_file)
+        fingerprint, is_stable = file_fingerprint(key)
+
+        cached = _parsed_shelves.get(key)
+        if cached and cached[0] == fingerprint:
+            # the file is unchanged since we last parsed it; callers may edit
+            # the steps they are given, so hand out a fresh copy
+            _, self.version, steps = cached
+            self.steps = {s: list(deps) for s, deps in steps.items()}
+            return
+
         config = load_yaml(self.config_file)
-        jsonschema.validate(config, SHELF_SCHEMA)
+        validate(config, SHELF_VALIDATOR)
 
         self.version = config["version"]
         self.steps = {
@@ -34,6 +47,10 @@ class Shelf:
             for s, deps in config["steps"].items()
         }
 
+        if is_stable:
+            steps = {s: list(deps) for s, deps in self.steps.items()}
+            _parsed_shelves[key] = (fingerprint, self.version, steps)
+
     @staticmethod
     def init(shelf_file: Path = DEFAULT_SHELF_PATH) -> "Shelf":
         if not shelf_file.exists():
@@ -51,13 +68,15 @@ class Shelf:
         return Shelf()
 
     def save(self) -> None:
+        # sort on plain strings, which compare in C, rather than on StepURIs
         config = {
             "version": self.version,
             "steps": {
-                str(k): [str(v) for v in vs] for k, vs in sorted(self.steps.items())
+                k.uri: [v.uri for v in vs]
+                for k, vs in sorted(self.steps.items(), key=lambda item: item[0].uri)
             },
         }
-        jsonschema.validate(config, SHELF_SCHEMA)
+        validate(config, SHELF_VALIDATOR)
         save_yaml(config, self.config_file)
 
     def new_table(self, table_path: str, dependencies: list[str]) -> None:
@@ -71,9 +90,16 @@ class Shelf:
     def get_latest_version(self, step: StepURI) -> StepURI:
         assert step.path.endswith("/latest")
         prefix = step.path.rsplit("/", 1)[0]
-        versions = [
-            s
-            for s in self.steps
-            if s.scheme == step.scheme and s.path.startswith(prefix)
-        ]
-        return max(versions)
+        latest = max(
+            (
+                s
+                for s in self.steps
+                if s.scheme == step.scheme and s.path.startswith(prefix)
+            ),
+            key=lambda s: s.uri,
+            default=None,
+        )
+        if latest is None:
+            raise ValueError(f"No versions of {step} found in the shelf")
+
+        return latest
@@ -1,7 +1,8 @@
 import json
-import jsonschema
 from pathlib import Path
 
+import jsonschema
+
 SCHEMA_DIR = Path(__file__).parent / "schemas"
 
 SNAPSHOT_SCHEMA_FILE = SCHEMA_DIR / "snapshot-v1.schema.json"
@@ -13,10 +14,33 @@ TABLE_CONFIG_SCHEMA_FILE = SCHEMA_DIR / "table-config-v1.schema.json"
 def validate_snapshot(snapshot: dict) -> None:
     # Prune missing values
     pruned_snapshot = {k: v for k, v in snapshot.items() if v is not None}
-    jsonschema.validate(pruned_snapshot, SNAPSHOT_SCHEMA)
+    validate(pruned_snapshot, SNAPSHOT_VALIDATOR)
+
+
+def validate(instance: dict, validator: jsonschema.protocols.Validator) -> None:
+    "Like jsonschema.validate(), but with a validator that was built ahead of time."
+    error = jsonschema.exceptions.best_match(validator.iter_errors(instance))
+    if error is not None:
+        raise error
+
+
+def build_validator(schema: dict) -> jsonschema.protocols.Validator:
+    # jsonschema.validate() checks the schema and builds a fresh validator on
+    # every call, so we do that once per schema instead
+    validator_cls = jsonschema.validators.validator_for(schema)
+    validator_cls.check_schema(schema)
+    return validator_cls(schema)
+
+
+def _load_schema(path: Path) -> dict:
+    return json.loads(path.read_bytes())
+
 
+SNAPSHOT_SCHEMA = _load_schema(SNAPSHOT_SCHEMA_FILE)
+TABLE_SCHEMA = _load_schema(TABLE_SCHEMA_FILE)
+TABLE_CONFIG_SCHEMA = _load_schema(TABLE_CONFIG_SCHEMA_FILE)
+SHELF_SCHEMA = _load_schema(SHELF_SCHEMA_FILE)
 
-SNAPSHOT_SCHEMA = json.loads(SNAPSHOT_SCHEMA_FILE.read_text())
-TABLE_SCHEMA = json.loads(TABLE_SCHEMA_FILE.read_text())
-TABLE_CONFIG_SCHEMA = json.loads(TABLE_CONFIG_SCHEMA_FILE.read_text())
-SHELF_SCHEMA = json.loads(SHELF_SCHEMA_FILE.read_text())
+SNAPSHOT_VALIDATOR = build_validator(SNAPSHOT_SCHEMA)
+SHELF_VALIDATOR = build_validator(SHELF_SCHEMA)
+TABLE_CONFIG_VALIDATOR = build_validator(TABLE_CONFIG_SCHEMA)
@@ -6,27 +6,58 @@
 
 
 import os
+import shlex
 import shutil
 import subprocess
+import tempfile
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from dataclasses import asdict, dataclass
+from functools import cache
 from pathlib import Path
-from typing import Any, Literal, Optional, Union
-
-import boto3
-import jsonschema
+from typing import TYPE_CHECKING, Any, Literal, Optional, Union
 
+from shelf.exceptions import StepDefinitionError
 from shelf.paths import BASE_DIR, SNAPSHOT_DIR
-from shelf.schemas import SNAPSHOT_SCHEMA, validate_snapshot
+from shelf.schemas import SNAPSHOT_VALIDATOR, validate, validate_snapshot
 from shelf.types import Checksum, DatasetName, FileName, Manifest, StepURI
 from shelf.utils import (
-    checksum_file,
+    FileFingerprint,
+    checksum_file_cached,
     checksum_folder,
     checksum_manifest,
+    copy_and_checksum_file,
+    file_fingerprint,
+    list_folder,
     load_yaml,
     print_op,
     save_yaml,
 )
 
+if TYPE_CHECKING:
+    from boto3.s3.transfer import TransferConfig
+
+# S3 requests are latency-bound, so keep several in flight at once; workers
+# also hash files, so we scale with the number of cores
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+MB = 1024 * 1024
+
+# parts of a single large object that are transferred at once
+DEFAULT_S3_MAX_CONCURRENCY = 10
+
+# snapshot steps may run concurrently, each with its own pool of workers, so
+# we cap the transfers across all of them to fit the client's connection pool
+_transfer_slots = threading.BoundedSemaphore(MAX_WORKERS)
+
+_metadata_cache: dict[str, tuple[FileFingerprint, dict[str, Any]]] = {}
+
 
 @dataclass
 class Snapshot:
@@ -59,17 +90,17 @@ class Snapshot:
 
     @property
     def metadata_path(self) -> Path:
-        return (SNAPSHOT_DIR / self.uri.path).with_suffix(".meta.yaml")
+        return SNAPSHOT_DIR / f"{self.uri.path}.meta.yaml"
 
     @staticmethod
     def load(path: str) -> "Snapshot":
         "Load an existing snapshot from its metadata file."
-        metadata_file = (SNAPSHOT_DIR / path).with_suffix(".meta.yaml")
+        metadata_file = SNAPSHOT_DIR / f"{path}.meta.yaml"
 
-        metadata = load_yaml(metadata_file)
-        if "date_accessed" in metadata:
-            metadata["date_accessed"] = str(metadata["date_accessed"])
-        jsonschema.validate(metadata, SNAPSHOT_SCHEMA)
+        # snapshots can be modified and saved, so each gets its own copy
+        metadata = dict(_load_metadata(metadata_file))
+        if metadata.get("manifest"):
+            metadata["manifest"] = dict(metadata["manifest"])
 
         metadata["uri"] = StepURI.parse(metadata["uri"])
 
@@ -96,11 +127,14 @@ class Snapshot:
     ) -> "Snapshot":
         data_path = SNAPSHOT_DIR / dataset_name
 
-        # copy directory to data/snapshots/...
-        copy_dir(local_path, data_path)
+        # copy directory to data/snapshots/..., checksumming as we go
+        checksums = None
+        if local_path.resolve() != data_path.resolve():
+            # if you edit a snapshot in place, the paths may be the same
+            checksums = copy_dir(local_path, data_path)
 
         # upload to s3
-        manifest = add_directory_to_s3(data_path)
+        manifest = add_directory_to_s3(data_path, checksums)
         checksum = checksum_manifest(manifest)
 
         # Create metadata record
@@ -148,14 +182,14 @@ class Snapshot:
     def create_from_file(
         local_path: Path, dataset_name: DatasetName, metadata: Optional[dict[str, Any]]
     ) -> "Snapshot":
-        # first we checksum
-        checksum = checksum_file(local_path)
-
-        # then copy it over right away, as a convenience
+        # copy it over right away as a convenience, checksumming as we go
         data_path = (SNAPSHOT_DIR / dataset_name).with_suffix(local_path.suffix)
-        if local_path != data_path:
+        if local_path.resolve() != data_path.resolve():
+            checksum = copy_file(local_path, data_path)
+
+        else:
             # if you edit a snapshot in place, the paths may be the same
-            copy_file(local_path, data_path)
+            checksum = checksum_file_cached(local_path)
 
         # it tells us the s3 path to store it at
         add_to_s3(data_path, checksum)
@@ -174,12 +208,30 @@ class Snapshot:
 
     def is_up_to_date(self):
         if self.snapshot_type == "file":
-            return self.path.exists() and self.checksum == checksum_file(self.path)
+            return self.path.exists() and self.checksum == checksum_file_cached(
+                self.path
+            )
 
         elif self.snapshot_type == "directory":
-            return self.path.is_dir() and self.checksum == checksum_manifest(
-                checksum_folder(self.path)
-            )
+            if not self.path.is_dir():
+                return False
+
+            if self.manifest is None:
+                return self.checksum == checksum_manifest(
+                    checksum_folder(self.path, checksum_file_cached)
+                )
+
+            # added or removed files show up without reading any contents
+            files = list_folder(self.path)
+            if files.keys() != self.manifest.keys():
+                return False
+
+            # stop at the first changed file, rather than hashing them all
+            for file_name, file_path in files.items():
+                if checksum_file_cached(file_path) != self.manifest[file_name]:
+                    return False
+
+            return self.checksum == checksum_manifest(self.manifest)
 
         raise ValueError(f"Unknown snapshot type: {self.snapshot_type}")
 
@@ -191,6 +243,12 @@ class Snapshot:
         elif self.snapshot_type == "directory":
             assert self.manifest is not None
 
+            # refuse manifests that would write outside the snapshot directory
+            dest_paths = {
+                file_name: self.path / _safe_relative_path(file_name)
+                for file_name in self.manifest
+            }
+
             # if the diretory exists, remove any files that are not in the manifest
             if self.path.exists():
                 for file_name in self.path.iterdir():
@@ -198,55 +256,174 @@ class Snapshot:
                         print_op("DELETE", file_name)
                         file_name.unlink()
 
+            # files with identical contents share an object, so we fetch each
+            # object once and copy it locally for the duplicates
+            copies: dict[Checksum, list[Path]] = {}
             for file_name, checksum in self.manifest.items():
-                fetch_from_s3(checksum, self.path / file_name)
+                copies.setdefault(checksum, []).append(dest_paths[file_name])
+
+            def fetch_copies(checksum: Checksum, paths: list[Path]) -> None:
+                first, *rest = paths
+                fetch_from_s3(checksum, first)
+                for path in rest:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copyfile(first, path)
+
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = [
+                    executor.submit(fetch_copies, checksum, paths)
+                    for checksum, paths in copies.items()
+                ]
+                for future in futures:
+                    future.result()
             return
 
         raise ValueError(f"Unknown snapshot type: {self.snapshot_type}")
 
 
-def add_directory_to_s3(file_path: Path) -> dict[FileName, Checksum]:
-    checksums = checksum_folder(file_path)
-    for file_name, checksum in checksums.items():
-        add_to_s3(file_path / file_name, checksum)
+def _load_metadata(metadata_file: Path) -> dict[str, Any]:
+    # a snapshot used by many tables is loaded once per dependent step, so we
+    # keep the validated metadata for as long as the file is unchanged
+    key = os.path.abspath(metadata_file)
+    fingerprint, is_stable = file_fingerprint(key)
 
-    return checksums
+    cached = _metadata_cache.get(key)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    metadata = load_yaml(metadata_file)
+    if "date_accessed" in metadata:
+        metadata["date_accessed"] = str(metadata["date_accessed"])
+    validate(metadata, SNAPSHOT_VALIDATOR)
+
+    if is_stable:
+        _metadata_cache[key] = (fingerprint, metadata)
+
+    return metadata
+
+
+def _safe_relative_path(file_name: FileName) -> str:
+    # a purely lexical check, so that we don't touch the filesystem per file
+    norm_path = os.path.normpath(file_name)
+    if (
+        os.path.isabs(norm_path)
+        or norm_path == os.pardir
+        or norm_path.startswith(os.pardir + os.sep)
+    ):
+        raise StepDefinitionError(
+            f"Manifest entry escapes the snapshot directory: {file_name}"
+        )
+
+    return norm_path
+
+
+def add_directory_to_s3(
+    file_path: Path, checksums: Manifest | None = None
+) -> dict[FileName, Checksum]:
+    files = list_folder(file_path)
+
+    # files with identical contents share an object, which we only need to
+    # check for and upload once
+    claimed: set[Checksum] = set()
+    claimed_lock = threading.Lock()
+
+    def checksum_and_upload(file_name: FileName) -> Checksum:
+        # reuse any checksum we took while copying the file, or from an
+        # earlier run if the file has not changed since
+        if checksums and file_name in checksums:
+            checksum = checksums[file_name]
+        else:
+            checksum = checksum_file_cached(files[file_name])
+
+        with claimed_lock:
+            is_duplicate = checksum in claimed
+            claimed.add(checksum)
+
+        if not is_duplicate:
+            add_to_s3(files[file_name], checksum)
+
+        return checksum
+
+    manifest = {}
+    pending: dict[Future[Checksum], FileName] = {}
+
+    # keep a bounded number of uploads in flight, topping up as each one
+    # finishes, so that one slow upload never holds up the rest
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for file_name in files:
+            if len(pending) >= 2 * MAX_WORKERS:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    manifest[pending.pop(future)] = future.result()
+
+            pending[executor.submit(checksum_and_upload, file_name)] = file_name
+
+        for future in as_completed(pending):
+            manifest[pending[future]] = future.result()
+
+    return {file_name: manifest[file_name] for file_name in files}
 
 
 def add_to_s3(file_path: Union[str, Path], checksum: Checksum) -> None:
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=os.environ["S3_ACCESS_KEY"],
-        aws_secret_access_key=os.environ["S3_SECRET_KEY"],
-        endpoint_url=os.environ["S3_ENDPOINT_URL"],
-    )
+    s3 = s3_client()
     bucket_name = os.environ["S3_BUCKET_NAME"]
     dest_path = f"{checksum[:2]}/{checksum[2:4]}/{checksum}"
-    print_op("UPLOAD", file_path)
-    s3.upload_file(file_path, bucket_name, str(dest_path))
 
+    with _transfer_slots:
+        # objects are content-addressed, so an existing one already holds our data
+        if exists_in_s3(s3, bucket_name, dest_path):
+            print_op("ALREADY STORED", file_path)
+            return
+
+        print_op("UPLOAD", file_path)
+        s3.upload_file(file_path, bucket_name, str(dest_path), Config=transfer_config())
+
+
+def exists_in_s3(s3, bucket_name: str, key: str) -> bool:
+    from botocore.exceptions import ClientError
 
-def open_in_editor(self, file_path: Path) -> None:
-    editor = os.getenv("EDITOR", "vim")
-    subprocess.run([editor, file_path])
+    try:
+        s3.head_object(Bucket=bucket_name, Key=key)
+    except ClientError:
+        # a missing key is a 404, but credentials without s3:ListBucket get a
+        # 403 instead; if we can't tell, uploading again is always safe
+        return False
 
+    return True
 
-def copy_file(local_path: Path, data_path: Path) -> None:
+
+def open_in_editor(file_path: Path) -> None:
+    # $EDITOR may carry its own arguments, e.g. "code --wait"
+    editor = shlex.split(os.getenv("EDITOR") or "vim")
+    subprocess.run(editor + [str(file_path)])
+
+
+def copy_file(local_path: Path, data_path: Path) -> Checksum:
     assert not Path(local_path).is_dir()
 
     data_path.parent.mkdir(parents=True, exist_ok=True)
 
     print_op("ADD", f"{data_path.relative_to(BASE_DIR)}")
-    shutil.copy(local_path, data_path)
+    return copy_and_checksum_file(local_path, data_path)
 
 
-def copy_dir(local_path: Path, data_path: Path) -> None:
+def copy_dir(local_path: Path, data_path: Path) -> Manifest:
+    "Copy a directory, returning the checksums of the files we copied."
     assert local_path.is_dir()
 
     data_path.parent.mkdir(parents=True, exist_ok=True)
 
     print_op("ADD", f"{data_path.relative_to(BASE_DIR)}/")
-    shutil.copytree(local_path, data_path)
+
+    checksums = {}
+
+    def copy_and_checksum(src: str, dest: str) -> None:
+        file_name = Path(dest).relative_to(data_path).as_posix()
+        checksums[file_name] = copy_and_checksum_file(src, dest)
+
+    shutil.copytree(local_path, data_path, copy_function=copy_and_checksum)
+
+    return checksums
 
 
 def is_completed(uri: StepURI) -> bool:
@@ -258,24 +435,66 @@ def download_file(s3_path: str, dest_path: Path) -> None:
     s3 = s3_client()
 
     bucket_name = os.environ["S3_BUCKET_NAME"]
-    dest_path_rel = dest_path.resolve().relative_to(BASE_DIR.resolve())
+
+    # our data paths are already relative to the working directory, so only
+    # resolve the odd absolute path rather than walking the filesystem per file
+    if dest_path.is_absolute():
+        dest_path_rel = dest_path.resolve().relative_to(BASE_DIR.resolve())
+    else:
+        dest_path_rel = dest_path
 
     print_op(
         "DOWNLOAD",
         dest_path_rel,
     )
 
-    s3.download_file(bucket_name, s3_path, str(dest_path))
+    with _transfer_slots:
+        s3.download_file(bucket_name, s3_path, str(dest_path), Config=transfer_config())
+
+
+def transfer_config() -> "TransferConfig":
+    from boto3.s3.transfer import TransferConfig
+
+    # split large objects into parts that are transferred in parallel
+    return TransferConfig(
+        multipart_threshold=8 * MB,
+        multipart_chunksize=16 * MB,
+        max_concurrency=s3_max_concurrency(),
+        use_threads=True,
+    )
+
+
+def s3_max_concurrency() -> int:
+    return int(os.environ.get("S3_MAX_CONCURRENCY", DEFAULT_S3_MAX_CONCURRENCY))
 
 
 def s3_client():
-    s3 = boto3.client(
+    return _s3_client(
+        os.environ["S3_ACCESS_KEY"],
+        os.environ["S3_SECRET_KEY"],
+        os.environ["S3_ENDPOINT_URL"],
+    )
+
+
+# clients are thread-safe but slow to build, so we share one per credentials
+@cache
+def _s3_client(access_key: str, secret_key: str, endpoint_url: str):
+    import boto3
+    from botocore.config import Config
+
+    session = boto3.session.Session()
+    return session.client(
         "s3",
-        aws_access_key_id=os.environ["S3_ACCESS_KEY"],
-        aws_secret_access_key=os.environ["S3_SECRET_KEY"],
-        endpoint_url=os.environ["S3_ENDPOINT_URL"],
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        endpoint_url=endpoint_url,
+        config=Config(
+            # a connection for every part of every transfer we allow at once
+            max_pool_connections=MAX_WORKERS * s3_max_concurrency(),
+            # back off when the store throttles us
+            retries={"max_attempts": 10, "mode": "adaptive"},
+        ),
     )
-    return s3
 
 
 def check_local_cache(checksum: Checksum) -> Optional[Path]:
@@ -295,7 +514,9 @@ def fetch_from_s3(checksum: Checksum, dest_path: Path) -> None:
 
     cache_path = check_local_cache(checksum)
     if cache_path:
-        shutil.copy(cache_path, dest_path)
+        # copyfile() uses the kernel's zero-copy path and skips copying
+        # permissions, which the cache has no use for
+        shutil.copyfile(cache_path, dest_path)
         return
 
     s3_path = f"{checksum[:2]}/{checksum[2:4]}/{checksum}"
@@ -306,7 +527,17 @@ def fetch_from_s3(checksum: Checksum, dest_path: Path) -> None:
     )
     cache_path.parent.mkdir(parents=True, exist_ok=True)
     print_op("CACHE ADD", f"~/{cache_path.relative_to(Path.home())}")
-    shutil.copy(dest_path, cache_path)
+
+    # other workers or processes may be reading this entry as soon as it
+    # exists, so it must only ever appear complete
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=f".{checksum}.")
+    os.close(fd)
+    try:
+        shutil.copyfile(dest_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 
 def prune_empty_values(record):
@@ -1,11 +1,17 @@
+import graphlib
+import os
 import re
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from typing import List
 
-import graphlib
-
 from shelf import snapshots, tables
 from shelf.types import Dag, StepURI
 
+# most steps wait on subprocesses or the network, but table builds can be
+# CPU-heavy, so by default we run as many at once as we have cores
+MAX_JOBS = os.cpu_count() or 1
+
 
 def prune_with_regex(dag: Dag, regex: str, descendents: bool = True) -> Dag:
     "Reduce to regex."
@@ -15,10 +21,8 @@ def prune_with_regex(dag: Dag, regex: str, descendents: bool = True) -> Dag:
         for dep in deps:
             step_to_downstream.setdefault(dep, []).append(step)
 
-    queue = []
-    for step in step_to_upstream:
-        if re.search(regex, str(step)):
-            queue.append(step)
+    pattern = re.compile(regex)
+    queue = [step for step in step_to_upstream if pattern.search(step.uri)]
 
     include = set()
     while queue:
@@ -64,14 +68,48 @@ def is_completed(step: StepURI, deps: list[StepURI]) -> bool:
     raise ValueError(f"Unknown scheme {step.scheme}")
 
 
-def execute_dag(dag: Dag, dry_run: bool = False) -> None:
-    "Execute the DAG."
+def execute_dag(dag: Dag, dry_run: bool = False, jobs: int | None = None) -> None:
+    "Execute the DAG, running independent steps concurrently."
     to_execute = in_topological_order(dag)
     print(f"Executing {len(to_execute)} steps")
-    for step in to_execute:
-        print(step)
-        if not dry_run:
-            execute_step(step, dag[step])
+    if dry_run:
+        for step in to_execute:
+            print(step)
+        return
+
+    sorter = graphlib.TopologicalSorter(dag)
+    sorter.prepare()
+
+    # start each step as soon as its last dependency finishes, rather than
+    # waiting for a whole layer of the graph to complete
+    max_jobs = MAX_JOBS if jobs is None else jobs
+    ready: deque[StepURI] = deque()
+    running: dict[Future[None], StepURI] = {}
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        while sorter.is_active():
+            for step in sorter.get_ready():
+                if step not in dag:
+                    # a dependency that is already complete
+                    sorter.done(step)
+                    continue
+
+                ready.append(step)
+
+            # never queue more steps than there are workers, so that after a
+            # failure or Ctrl-C we only wait for the steps already running
+            while ready and len(running) < max_jobs:
+                step = ready.popleft()
+                print(step)
+                running[executor.submit(execute_step, step, dag[step])] = step
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                # re-raise the first failure; nothing new is started after it
+                future.result()
+                sorter.done(running.pop(future))
 
 
 def execute_step(step: StepURI, dependencies: List[StepURI]) -> None:
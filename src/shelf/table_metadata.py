@@ -3,17 +3,19 @@
 import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import TYPE_CHECKING, Any, Dict, List
 
 import jsonschema
-import polars as pl
 from rich.console import Console
 
 from shelf.exceptions import ValidationError
 from shelf.paths import SNAPSHOT_DIR, TABLE_DIR, TABLE_SCRIPT_DIR
-from shelf.schemas import TABLE_CONFIG_SCHEMA
+from shelf.schemas import TABLE_CONFIG_VALIDATOR, validate
 from shelf.types import StepURI
-from shelf.utils import checksum_file, load_yaml, save_yaml
+from shelf.utils import checksum_file, checksum_file_cached, load_yaml, save_yaml
+
+if TYPE_CHECKING:
+    import polars as pl
 
 console = Console()
 
@@ -30,6 +32,8 @@ class ValidationResult:
 class TableMetadata:
     def __init__(self, uri: StepURI):
         self.uri = uri
+        # finding the script costs several stats, so we only do it once
+        self.executable = _get_executable(uri, check=False)
         self.config = self._load_config()
         self.inherited: Dict[str, Any] = {}
         self.runtime: Dict[str, Any] = {}
@@ -42,7 +46,7 @@ class TableMetadata:
 
         config = load_yaml(config_path)
         try:
-            jsonschema.validate(config, TABLE_CONFIG_SCHEMA)
+            validate(config, TABLE_CONFIG_VALIDATOR)
         except jsonschema.ValidationError as e:
             raise ValidationError(f"Invalid table configuration: {e}")
 
@@ -50,8 +54,7 @@ class TableMetadata:
 
     def _get_config_path(self) -> Path:
         """Get the path to the table's metadata configuration file."""
-        executable = _get_executable(self.uri, check=False)
-        return Path(executable).with_suffix(".meta.yaml")
+        return self.executable.with_suffix(".meta.yaml")
 
     def resolve_inheritance(self, dependencies: List[StepURI]) -> None:
         """Resolve and validate inherited metadata from dependencies."""
@@ -93,13 +96,16 @@ class TableMetadata:
                 }
             )
 
-    def validate_schema(self, df: pl.DataFrame) -> ValidationResult:
-        """Validate the dataframe against schema specifications."""
+    def validate_schema(self, table: "pl.LazyFrame") -> ValidationResult:
+        """Validate the table against schema specifications."""
         errors = []
 
+        # parquet keeps the schema in its footer, so this doesn't read any data
+        schema = table.collect_schema()
+
         # Check schema if specified
         if schema_spec := self.config.get("schema"):
-            df_schema = {col: str(dtype) for col, dtype in df.schema.items()}
+            df_schema = {col: str(dtype) for col, dtype in schema.items()}
             for col, dtype in schema_spec.items():
                 if col not in df_schema:
                     errors.append(f"Missing column: {col}")
@@ -112,22 +118,34 @@ class TableMetadata:
         if validation := self.config.get("validation"):
             # Check required columns
             for col in validation.get("required_columns", []):
-                if col not in df.columns:
+                if col not in schema:
                     errors.append(f"Required column missing: {col}")
 
-            # Check unique columns
-            for col in validation.get("unique_columns", []):
-                if col in df.columns and df[col].n_unique() != len(df):
-                    errors.append(f"Column not unique: {col}")
-
-            # Check for null values
-            for col in validation.get("not_null", []):
-                if col in df.columns and df[col].null_count() > 0:
-                    errors.append(f"Column contains null values: {col}")
+            # only read the columns that the remaining checks need
+            unique_cols = [
+                c for c in validation.get("unique_columns", []) if c in schema
+            ]
+            not_null_cols = [c for c in validation.get("not_null", []) if c in schema]
+            if unique_cols or not_null_cols:
+                df = table.select(
+                    list(dict.fromkeys(unique_cols + not_null_cols))
+                ).collect()
+
+                # Check unique columns
+                for col in unique_cols:
+                    if df[col].n_unique() != len(df):
+                        errors.append(f"Column not unique: {col}")
+
+                # Check for null values
+                for col in not_null_cols:
+                    if df[col].null_count() > 0:
+                        errors.append(f"Column contains null values: {col}")
 
         return ValidationResult(not errors, errors)
 
-    def generate(self, output_path: Path, dependencies: List[StepURI]) -> dict:
+    def generate(
+        self, output_path: Path, dependencies: List[StepURI], schema: "pl.Schema"
+    ) -> dict:
         """Generate the final metadata for the table."""
         # Start with inherited metadata
         metadata = self.inherited.copy()
@@ -137,8 +155,7 @@ class TableMetadata:
         metadata.update(overrides)
 
         # Add schema information
-        df = pl.read_parquet(output_path)
-        metadata["schema"] = {col: str(dtype) for col, dtype in df.schema.items()}
+        metadata["schema"] = {col: str(dtype) for col, dtype in schema.items()}
 
         # Add execution information
         metadata["execution"] = self.runtime
@@ -160,19 +177,18 @@ class TableMetadata:
         manifest = {}
 
         # Add the script we used to generate the table
-        executable = _get_executable(self.uri)
-        manifest[str(executable)] = checksum_file(executable)
+        manifest[str(self.executable)] = checksum_file_cached(self.executable)
 
         # Add the metadata config if it exists
         config_path = self._get_config_path()
         if config_path.exists():
-            manifest[str(config_path)] = checksum_file(config_path)
+            manifest[str(config_path)] = checksum_file_cached(config_path)
 
         # add every dependency's metadata file; that file includes a checksum of its data,
         # so we cover both data and metadata this way
         for dep in dependencies:
             dep_metadata_file = _metadata_path(dep)
-            manifest[str(dep_metadata_file)] = checksum_file(dep_metadata_file)
+            manifest[str(dep_metadata_file)] = checksum_file_cached(dep_metadata_file)
 
         return manifest
 
@@ -192,15 +208,19 @@ def process_table_metadata(
     # Use the runtime info from table execution
     metadata.runtime = runtime_info
 
-    # Read and validate the generated table
-    df = pl.read_parquet(output_path)
-    validation_result = metadata.validate_schema(df)
+    import polars as pl
+
+    # Validate the generated table, reading only as much of it as we need
+    table = pl.scan_parquet(output_path)
+    validation_result = metadata.validate_schema(table)
     if not validation_result:
         error_msg = "\n".join(validation_result.errors)
         raise ValidationError(f"Table validation failed for {uri}:\n{error_msg}")
 
     # Generate and save final metadata
-    final_metadata = metadata.generate(output_path, dependencies)
+    final_metadata = metadata.generate(
+        output_path, dependencies, table.collect_schema()
+    )
     save_yaml(final_metadata, _metadata_path(uri))
 
 
@@ -230,10 +250,10 @@ def _is_valid_script(script: Path) -> bool:
 
 def _metadata_path(uri: StepURI) -> Path:
     if uri.scheme == "snapshot":
-        return (SNAPSHOT_DIR / uri.path).with_suffix(".meta.yaml")
+        return SNAPSHOT_DIR / f"{uri.path}.meta.yaml"
 
     elif uri.scheme == "table":
-        return (TABLE_DIR / f"{uri.path}.parquet").with_suffix(".meta.yaml")
+        return TABLE_DIR / f"{uri.path}.meta.yaml"
 
     else:
         raise ValueError(f"Unknown scheme {uri.scheme}")
@@ -1,21 +1,18 @@
+import os
 import subprocess
 import sys
 from collections import Counter
 from datetime import datetime
+from functools import cache
 from pathlib import Path
-from typing import Any, Iterator
-
-import duckdb
-import jsonschema
-import polars as pl
+from typing import Any
 
 from shelf.exceptions import ValidationError
 from shelf.paths import TABLE_DIR
-from shelf.schemas import TABLE_SCHEMA
 from shelf.snapshots import Snapshot
 from shelf.table_metadata import _get_executable, _metadata_path, process_table_metadata
-from shelf.types import Manifest, StepURI
-from shelf.utils import checksum_file, load_yaml, print_op, save_yaml
+from shelf.types import StepURI
+from shelf.utils import checksum_file_cached, load_yaml, print_op
 
 
 def is_completed(uri: StepURI, deps: list[StepURI]) -> bool:
@@ -34,15 +31,23 @@ def is_completed(uri: StepURI, deps: list[StepURI]) -> bool:
 
     # Check if metadata config exists and is up to date
     config_path = Path(_get_executable(uri)).with_suffix(".meta.yaml")
-    if config_path.exists():
-        if str(config_path) not in input_manifest:
-            return False
-        if checksum_file(config_path) != input_manifest[str(config_path)]:
-            return False
+    if config_path.exists() and str(config_path) not in input_manifest:
+        return False
+
+    # The metadata file is written last when a table is built, so if no input
+    # has been touched since, we can skip checksumming them entirely
+    try:
+        input_mtimes = [os.stat(path).st_mtime_ns for path in input_manifest]
+    except FileNotFoundError:
+        return False
+
+    built_at = metadata_path.stat().st_mtime_ns
+    if all(mtime < built_at for mtime in input_mtimes):
+        return True
 
     # Check script and dependency checksums
     for path, checksum in input_manifest.items():
-        if not Path(path).exists() or checksum != checksum_file(path):
+        if not Path(path).exists() or checksum != checksum_file_cached(path):
             return False
 
     return True
@@ -161,127 +166,76 @@ def _exec_sql_command(uri: StepURI, command: list[Path]) -> None:
     with open(sql_file, "r") as f:
         sql = f.read().format(**template_vars)
 
-    con = duckdb.connect(database=":memory:")
+    import duckdb
+
+    # each step gets its own cursor, so its temporary tables are private to it
     sql = f"CREATE TEMPORARY TABLE data AS ({sql})"
-    try:
-        con.execute(sql)
+    with _duckdb_connection().cursor() as con:
+        try:
+            con.execute(sql)
 
-    except duckdb.ParserException as e:
-        raise ValueError(f"Error executing the following SQL\n\n{sql}\n\n{e}")
+        except duckdb.ParserException as e:
+            raise ValueError(f"Error executing the following SQL\n\n{sql}\n\n{e}")
 
-    except duckdb.BinderException as e:
-        raise ValueError(f"Error executing the following SQL\n\n{sql}\n\n{e}")
+        except duckdb.BinderException as e:
+            raise ValueError(f"Error executing the following SQL\n\n{sql}\n\n{e}")
 
-    is_update = output_file.exists()
+        is_update = output_file.exists()
+
+        con.execute(f"COPY data TO '{output_file}' (FORMAT 'parquet')")
 
-    con.execute(f"COPY data TO '{output_file}' (FORMAT 'parquet')")
     if is_update:
         print_op("UPDATE", output_file)
     else:
         print_op("CREATE", output_file)
 
 
-def _generate_candidate_names(dep: Path) -> Iterator[str]:
-    parts = dep.parts
-    name = parts[-2]
-    yield name
+@cache
+def _duckdb_connection():
+    # opening a database takes ~10ms, so SQL steps share one in-memory database
+    import duckdb
 
-    candidates = [name]
-    for p in reversed(parts[:-2]):
-        name = f"{p}_{name}"
-        yield name
-
-    version = parts[-1].replace("-", "")
-    candidates.append(f"{name}_{version}")
-    while True:
-        yield name
-
-
-def _simplify_dependency_names(deps: list[Path]) -> dict[str, Path]:
-    mapping = {}
+    return duckdb.connect(database=":memory:")
 
-    to_map = {d: iter(_generate_candidate_names(d)) for d in deps}
 
-    frontier = {d: next(to_map[d]) for d in deps}
-    duplicates = {k for k, v in Counter(frontier.values()).items() if v >= 2}
+def _generate_candidate_names(dep: Path) -> list[str]:
+    "Possible template names for a dependency, from shortest to longest."
+    *parents, name, version = dep.parts
+    names = [name]
+    for p in reversed(parents):
+        names.append(f"{p}_{names[-1]}")
 
-    for d, name in list(frontier.items()):
-        if d not in duplicates:
-            mapping[name] = d
-            del frontier[d]
+    # only fall back to versioned names when the names alone are ambiguous
+    version = Path(version).stem.replace("-", "")
+    return names + [f"{n}_{version}" for n in names]
 
-    last_duplicates = duplicates
-    while duplicates:
-        frontier = {d: next(to_map[d]) for d in list(frontier)}
-        duplicates = {k for k, v in Counter(frontier.values()).items() if v >= 2}
-        if duplicates == last_duplicates:
-            raise Exception(f"infinite loop resolving dependencies: {deps}")
 
-        for d, name in list(frontier.items()):
-            if d not in duplicates:
+def _simplify_dependency_names(deps: list[Path]) -> dict[str, Path]:
+    candidates = {d: _generate_candidate_names(d) for d in deps}
+
+    mapping: dict[str, Path] = {}
+    remaining = list(deps)
+    depth = 0
+    while remaining:
+        for d in remaining:
+            if depth >= len(candidates[d]):
+                raise ValueError(f"Could not find a unique name for {d} among {deps}")
+
+        # only compare names at the same depth, so that a dependency keeps its
+        # short name whatever longer names the others might have
+        names = {d: candidates[d][depth] for d in remaining}
+        counts = Counter(names.values())
+
+        remaining = []
+        for d, name in names.items():
+            if counts[name] == 1 and name not in mapping:
                 mapping[name] = d
-                del frontier[d]
-
-    return mapping
-
-
-def _gen_metadata(uri: StepURI, dependencies: list[StepURI]) -> None:
-    dest_path = _metadata_path(uri)
-    metadata = {
-        "uri": str(uri),
-        "version": 1,
-        "checksum": checksum_file(TABLE_DIR / f"{uri.path}.parquet"),
-        "input_manifest": _generate_input_manifest(uri, dependencies),
-    }
-
-    if len(dependencies) == 1:
-        # inherit metadata from the dependency
-        dep_metadata_path = _metadata_path(dependencies[0])
-        dep_metadata = load_yaml(dep_metadata_path)
-        for field in [
-            "name",
-            "source_name",
-            "source_url",
-            "date_accessed",
-            "access_notes",
-        ]:
-            if field in dep_metadata:
-                metadata[field] = str(dep_metadata[field])
-
-    metadata["schema"] = _infer_schema(uri)
-
-    jsonschema.validate(metadata, TABLE_SCHEMA)
-
-    columns = list(metadata["schema"].keys())
-    if not any(col.startswith("dim_") for col in columns):
-        # we have not yet written this metadata, so the step is not yet complete
-        raise ValueError(
-            f"Table {uri} does not have any dimension columns prefixed with dim_, found: {columns}"
-        )
-
-    save_yaml(metadata, dest_path)
+            else:
+                remaining.append(d)
 
+        depth += 1
 
-def _generate_input_manifest(uri: StepURI, dependencies: list[StepURI]) -> Manifest:
-    manifest = {}
-
-    # add the script we used to generate the table
-    executable = _get_executable(uri)
-    manifest[str(executable)] = checksum_file(executable)
-
-    # add every dependency's metadata file; that file includes a checksum of its data,
-    # so we cover both data and metadata this way
-    for dep in dependencies:
-        dep_metadata_file = _metadata_path(dep)
-        manifest[str(dep_metadata_file)] = checksum_file(dep_metadata_file)
-
-    return manifest
-
-
-def _infer_schema(uri: StepURI) -> dict[str, str]:
-    data_path = TABLE_DIR / f"{uri.path}.parquet"
-    df = pl.read_parquet(data_path)
-    return {col: str(dtype) for col, dtype in df.schema.items()}
+    return mapping
 
 
 def add_placeholder_script(uri: StepURI) -> Path:
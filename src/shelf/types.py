@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from functools import total_ordering
+from functools import cache, cached_property, total_ordering
 from typing import Literal
 
 from shelf import paths
@@ -14,13 +14,15 @@ type Schema = dict[str, DType]
 
 
 @total_ordering
-@dataclass
+@dataclass(frozen=True)
 class StepURI:
     scheme: Literal["snapshot", "table"]
     path: DatasetName
 
-    @property
+    @cached_property
     def uri(self):
+        # steps are compared, hashed and printed via their uri, so we only
+        # format it once
         return f"{self.scheme}://{self.path}"
 
     @property
@@ -38,7 +40,10 @@ class StepURI:
         return self.full_path.relative_to(paths.BASE_DIR)
 
     @classmethod
+    @cache
     def parse(cls, uri: str) -> "StepURI":
+        # the same dependencies recur across many steps, so we parse each uri
+        # once and share the result, which is safe because steps are frozen
         scheme, path = uri.split("://")
         if scheme not in ["snapshot", "table"]:
             raise ValueError(f"Unknown scheme: {scheme}")
@@ -1,52 +1,265 @@
+import atexit
 import hashlib
+import mmap
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Union
+from typing import Any, NamedTuple, Union
 
 import yaml
 from rich.console import Console
 
 from shelf.paths import BASE_DIR
-from shelf.types import Checksum, Manifest
+from shelf.types import Checksum, FileName, Manifest
 
 console = Console()
 
-IGNORE_FILES = {".DS_Store"}
+# prefer libyaml's C implementation when PyYAML was built with it
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
 
+IGNORE_FILES = frozenset({".DS_Store"})
 
-def checksum_file(file_path: Union[str, Path]) -> Checksum:
-    sha256 = hashlib.sha256()
+# checksums double as S3 object keys, so changing the algorithm would orphan
+# every object already in the store
+CHECKSUM_ALGORITHM = "sha256"
+
+COPY_BUFSIZE = 1024 * 1024
+
+# above this size, we hash a memory map of the file in a single call
+MMAP_THRESHOLD = 8 * 1024 * 1024
+
+# files modified more recently than this may still be changing within the
+# resolution of their mtime, so we never trust anything cached about them
+CHECKSUM_CACHE_MIN_AGE_NS = 2_000_000_000
+
+# hashing a small file is quicker than looking it up in the database, so we
+# only keep checksums on disk for larger files
+CHECKSUM_CACHE_MIN_SIZE = 1024 * 1024
+
+CHECKSUM_CACHE_FILE = Path.home() / ".cache" / "shelf" / "checksums.sqlite"
+
+_checksum_cache: sqlite3.Connection | None = None
+_checksum_cache_failed = False
+_checksum_cache_lock = threading.Lock()
+_checksum_memo: dict[str, tuple["FileFingerprint", Checksum]] = {}
+# new rows, written in a single transaction when the command exits
+_checksum_cache_pending: list[tuple[str, int, int, int, int, Checksum]] = []
 
+
+def checksum_file(file_path: Union[str, Path]) -> Checksum:
     with open(file_path, "rb") as f:
-        for block in iter(lambda: f.read(4096), b""):
+        if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                return hashlib.new(CHECKSUM_ALGORITHM, mm).hexdigest()
+
+        # file_digest() hashes in large blocks without returning to Python per block
+        _advise_sequential(f.fileno())
+        return hashlib.file_digest(f, CHECKSUM_ALGORITHM).hexdigest()
+
+
+def _advise_sequential(fd: int) -> None:
+    # let the kernel read ahead more aggressively, since we read front to back
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+def copy_and_checksum_file(src: str | Path, dest: str | Path) -> Checksum:
+    "Copy a file, checksumming it as we go so that it is only read once."
+    # opening dest would truncate src before we had read it
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        raise shutil.SameFileError(f"{src!r} and {dest!r} are the same file")
+
+    sha256 = hashlib.new(CHECKSUM_ALGORITHM)
+
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        _advise_sequential(fin.fileno())
+        while block := fin.read(COPY_BUFSIZE):
             sha256.update(block)
+            fout.write(block)
+
+    shutil.copymode(src, dest)
 
     return sha256.hexdigest()
 
 
-def checksum_folder(dir_path: Path) -> Manifest:
-    manifest = {}
-    # walk the subdirectory tree, adding relative path and checksums to the manifest
-    for file_path in dir_path.rglob("*"):
-        if file_path.is_file():
-            if file_path.name in IGNORE_FILES:
-                continue
-            rel_path = file_path.relative_to(dir_path)
-            manifest[str(rel_path)] = checksum_file(file_path)
+class FileFingerprint(NamedTuple):
+    dev: int
+    ino: int
+    size: int
+    mtime_ns: int
+
+
+def file_fingerprint(path: str) -> tuple[FileFingerprint, bool]:
+    """
+    Identify the current contents of a file without reading it, and say whether
+    it is old enough for anything cached against that fingerprint to be trusted.
+    """
+    stat = os.stat(path)
+    # a file replaced by a rename gets a new inode, even if size and mtime match
+    fingerprint = FileFingerprint(
+        stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+    )
+    is_stable = time.time_ns() - stat.st_mtime_ns > CHECKSUM_CACHE_MIN_AGE_NS
+    return fingerprint, is_stable
+
+
+def checksum_file_cached(file_path: str | Path) -> Checksum:
+    "Checksum a file, reusing an earlier result if its inode, size and mtime are unchanged."
+    # the key includes the inode, so we needn't resolve symlinks to be safe
+    path = os.path.abspath(file_path)
+    fingerprint, is_stable = file_fingerprint(path)
+
+    # the same script or metadata file is often checked for many steps in one
+    # run, so we remember results in memory before going to the database
+    memo = _checksum_memo.get(path)
+    if memo and memo[0] == fingerprint:
+        return memo[1]
+
+    key = (path, *fingerprint)
+    use_database = is_stable and fingerprint.size >= CHECKSUM_CACHE_MIN_SIZE
+
+    if use_database and (checksum := _lookup_checksum(key)):
+        _checksum_memo[path] = (fingerprint, checksum)
+        return checksum
+
+    checksum = checksum_file(path)
+
+    if is_stable:
+        _checksum_memo[path] = (fingerprint, checksum)
+        if use_database:
+            with _checksum_cache_lock:
+                _checksum_cache_pending.append((*key, checksum))
+
+    return checksum
+
 
-    if not manifest:
+def _lookup_checksum(key: tuple[str, int, int, int, int]) -> Checksum | None:
+    try:
+        with _checksum_cache_lock:
+            cache = _get_checksum_cache()
+            if cache is None:
+                return None
+
+            row = cache.execute(
+                "SELECT checksum FROM file_checksums WHERE path = ? AND dev = ? "
+                "AND ino = ? AND size = ? AND mtime_ns = ?",
+                key,
+            ).fetchone()
+
+    except sqlite3.Error:
+        # the cache is only an optimisation, so if another process has it
+        # locked or it is unreadable, we just hash the file
+        return None
+
+    return row[0] if row else None
+
+
+def _get_checksum_cache() -> sqlite3.Connection | None:
+    "Open the checksum database on first use; call with the lock held."
+    global _checksum_cache, _checksum_cache_failed
+
+    if _checksum_cache is None and not _checksum_cache_failed:
+        try:
+            CHECKSUM_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            cache = sqlite3.connect(
+                CHECKSUM_CACHE_FILE, timeout=1, check_same_thread=False
+            )
+            # readers never wait on writers, and losing the last few rows in a
+            # power cut only costs us a re-hash
+            cache.execute("PRAGMA journal_mode=WAL")
+            cache.execute("PRAGMA synchronous=NORMAL")
+            cache.execute(
+                "CREATE TABLE IF NOT EXISTS file_checksums ("
+                "path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, "
+                "mtime_ns INTEGER, checksum TEXT)"
+            )
+        except (sqlite3.Error, OSError):
+            # don't keep retrying for every file in this run
+            _checksum_cache_failed = True
+            return None
+
+        _checksum_cache = cache
+        atexit.register(_flush_checksum_cache)
+
+    return _checksum_cache
+
+
+def _flush_checksum_cache() -> None:
+    "Write any new checksums to the database in a single transaction."
+    with _checksum_cache_lock:
+        rows = _checksum_cache_pending[:]
+        _checksum_cache_pending.clear()
+        cache = _get_checksum_cache() if rows else None
+
+        if cache is None:
+            return
+
+        try:
+            with cache:
+                cache.executemany(
+                    "INSERT OR REPLACE INTO file_checksums VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+        except sqlite3.Error:
+            pass
+
+
+def list_folder(dir_path: Path) -> dict[FileName, Path]:
+    # walk the subdirectory tree, mapping relative paths to full paths
+    files = dict(_walk_folder(str(dir_path), ""))
+
+    if not files:
         raise Exception(f'No files found in "{dir_path}" to checksum')
 
-    return manifest
+    return files
 
 
-def checksum_manifest(manifest: Manifest) -> Checksum:
-    sha256 = hashlib.sha256()
+def _walk_folder(dir_path: str, prefix: str) -> Iterator[tuple[FileName, Path]]:
+    # scandir entries know whether they are files or directories without an
+    # extra stat, and we build relative paths as we descend
+    with os.scandir(dir_path) as it:
+        entries = sorted(it, key=lambda e: e.name)
 
-    for file_name, checksum in sorted(manifest.items()):
-        sha256.update(file_name.encode())
-        sha256.update(checksum.encode())
+    for entry in entries:
+        if entry.name in IGNORE_FILES:
+            continue
 
-    return sha256.hexdigest()
+        rel_path = prefix + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            yield from _walk_folder(entry.path, rel_path + "/")
+
+        elif entry.is_file():
+            yield rel_path, Path(entry.path)
+
+
+def checksum_folder(
+    dir_path: Path, checksum: Callable[[Path], Checksum] = checksum_file
+) -> Manifest:
+    files = list_folder(dir_path)
+
+    # hashlib releases the GIL while hashing, so threads spread across cores
+    with ThreadPoolExecutor() as executor:
+        return dict(zip(files, executor.map(checksum, files.values())))
+
+
+def checksum_manifest(manifest: Manifest) -> Checksum:
+    # hash the names and checksums as one buffer; the bytes are exactly those we
+    # used to feed in pair by pair, so existing snapshot checksums still match
+    payload = "".join(
+        file_name + checksum for file_name, checksum in sorted(manifest.items())
+    )
+    return hashlib.new(CHECKSUM_ALGORITHM, payload.encode()).hexdigest()
 
 
 def print_op(type_: str, message: Any) -> None:
@@ -57,28 +270,40 @@ def add_to_gitignore(path: Path) -> None:
     gitignore = Path(".gitignore")
     path_str = str(path.relative_to(BASE_DIR))
 
-    if gitignore.exists():
-        with open(gitignore) as f:
-            entries = set(line.strip() for line in f if line.strip())
+    # one handle both reads the existing entries and appends, creating the
+    # file if it's missing
+    with gitignore.open("a+") as f:
+        f.seek(0)
+        content = f.read()
+        entries = set(line.strip() for line in content.splitlines() if line.strip())
 
         if path_str in entries:
             # it's already here
             return
 
-        print_op("UPDATE", ".gitignore")
-    else:
-        print_op("CREATE", ".gitignore")
+        print_op("UPDATE" if content else "CREATE", ".gitignore")
+
+        if content and not content.endswith("\n"):
+            # don't glue our entry onto an unterminated last line
+            f.write("\n")
 
-    with gitignore.open("a") as f:
-        print(path_str, file=f)
+        f.write(f"{path_str}\n")
 
 
 def dump_yaml_with_comments(obj: dict, f) -> None:
+    # emit each run of set values in one dump, rather than one dump per key
+    run = {}
     for key, value in obj.items():
         if value is None:
+            if run:
+                yaml.dump(run, f, Dumper=SafeDumper, sort_keys=False)
+                run = {}
             f.write(f"# {key}: \n")
         else:
-            yaml.dump({key: value}, f, sort_keys=False)
+            run[key] = value
+
+    if run:
+        yaml.dump(run, f, Dumper=SafeDumper, sort_keys=False)
 
 
 def save_yaml(obj: dict, path: Path, include_comments: bool = False) -> None:
@@ -91,8 +316,9 @@ def save_yaml(obj: dict, path: Path, include_comments: bool = False) -> None:
         if include_comments:
             dump_yaml_with_comments(obj, f)
         else:
-            yaml.dump(obj, f, sort_keys=False)
+            yaml.dump(obj, f, Dumper=SafeDumper, sort_keys=False)
 
 
 def load_yaml(path: Path) -> Any:
-    return yaml.safe_load(path.read_text())
+    # libyaml decodes UTF-8 itself, so there's no need to decode it in Python
+    return yaml.load(path.read_bytes(), Loader=SafeLoader)
@@ -1,5 +1,9 @@
+import dataclasses
 import os
 import shutil
+import sqlite3
+import subprocess
+import time
 from pathlib import Path
 
 import duckdb
@@ -13,10 +17,19 @@ from shelf import (
     list_steps,
     plan_and_run,
     snapshot_to_shelf,
+    steps,
+    utils,
 )
-from shelf.paths import BASE_DIR, TABLE_SCRIPT_DIR
+from shelf.exceptions import StepDefinitionError
+from shelf.paths import BASE_DIR, TABLE_DIR, TABLE_SCRIPT_DIR
+from shelf.snapshots import Snapshot
 from shelf.types import StepURI
-from shelf.utils import checksum_folder, load_yaml
+from shelf.utils import (
+    checksum_file_cached,
+    checksum_folder,
+    checksum_manifest,
+    load_yaml,
+)
 
 
 @pytest.fixture
@@ -48,6 +61,10 @@ def test_step_uri():
     assert uri.path == "test_namespace/test_dataset/2024-07-26"
     assert str(uri) == "snapshot://test_namespace/test_dataset/2024-07-26"
 
+    # parsed steps are shared, so they can't be modified
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        uri.path = "test_namespace/test_dataset/2024-07-27"  # type: ignore
+
 
 def test_path_variables_are_dynamic(setup_test_environment):
     tmp_path = setup_test_environment
@@ -124,6 +141,110 @@ def test_checksum_folder(setup_test_environment):
     }
 
 
+def test_checksum_manifest():
+    # directory snapshot checksums are stored in their metadata, so they must
+    # never change for the same manifest
+    manifest = {"b.txt": "1" * 64, "a/c.csv": "2" * 64}
+    assert (
+        checksum_manifest(manifest)
+        == "8c74bc848ad0374bbe0f7b989747770ac8cff1377331670b45a7c5f002876a9a"
+    )
+
+
+def test_checksum_file_cached(setup_test_environment):
+    tmp_path = setup_test_environment
+
+    data_file = tmp_path / "file1.txt"
+    data_file.write_text("Hello, World!")
+
+    # backdate the file so that its checksum is eligible for caching
+    an_hour_ago = time.time() - 3600
+    os.utime(data_file, (an_hour_ago, an_hour_ago))
+
+    expected = "dffd6021bb2bd5b0af676290809ec3a53191dd81c7f70a4b28688a362182986f"
+    assert checksum_file_cached(data_file) == expected
+    assert checksum_file_cached(data_file) == expected
+
+    # modifying the file invalidates the cached checksum
+    data_file.write_text("Hello, Cosmos!")
+    assert (
+        checksum_file_cached(data_file)
+        == "40efcea9db03adb126f27a0f339c595d1828a0713a789ea49d1ae67159d101e0"
+    )
+
+    # so does swapping in another file with the same size and mtime
+    os.utime(data_file, (an_hour_ago, an_hour_ago))
+    checksum_file_cached(data_file)
+    replacement = tmp_path / "file2.txt"
+    replacement.write_text("Hello, Planet!")
+    os.utime(replacement, (an_hour_ago, an_hour_ago))
+    replacement.replace(data_file)
+    assert (
+        checksum_file_cached(data_file)
+        == "f558ea505f50a3175b0c9acf9468edf487a1db61e8ecdd3b1d7ac76d053abf36"
+    )
+
+
+@pytest.fixture
+def checksum_cache(tmp_path, monkeypatch):
+    # a private database, so that we never write to the real ~/.cache
+    monkeypatch.setattr(utils, "CHECKSUM_CACHE_FILE", tmp_path / "checksums.sqlite")
+    monkeypatch.setattr(utils, "CHECKSUM_CACHE_MIN_SIZE", 0)
+    monkeypatch.setattr(utils, "_checksum_cache", None)
+    monkeypatch.setattr(utils, "_checksum_cache_failed", False)
+    monkeypatch.setattr(utils, "_checksum_cache_pending", [])
+    monkeypatch.setattr(utils, "_checksum_memo", {})
+
+    yield
+
+    if utils._checksum_cache is not None:
+        utils._checksum_cache.close()
+
+
+def test_checksum_file_cached_uses_database(
+    setup_test_environment, checksum_cache, monkeypatch
+):
+    tmp_path = setup_test_environment
+
+    data_file = tmp_path / "file1.txt"
+    data_file.write_text("Hello, World!")
+    an_hour_ago = time.time() - 3600
+    os.utime(data_file, (an_hour_ago, an_hour_ago))
+
+    expected = "dffd6021bb2bd5b0af676290809ec3a53191dd81c7f70a4b28688a362182986f"
+    assert checksum_file_cached(data_file) == expected
+    utils._flush_checksum_cache()
+
+    # a later run finds the checksum without hashing the file again
+    def checksum_file(path):
+        raise AssertionError(f"{path} should not be hashed")
+
+    monkeypatch.setattr(utils, "_checksum_memo", {})
+    monkeypatch.setattr(utils, "checksum_file", checksum_file)
+    assert checksum_file_cached(data_file) == expected
+
+
+def test_checksum_file_cached_without_database(
+    setup_test_environment, checksum_cache, monkeypatch
+):
+    tmp_path = setup_test_environment
+
+    data_file = tmp_path / "file1.txt"
+    data_file.write_text("Hello, World!")
+    an_hour_ago = time.time() - 3600
+    os.utime(data_file, (an_hour_ago, an_hour_ago))
+
+    # e.g. another shelf process is holding the database
+    def get_checksum_cache():
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(utils, "_get_checksum_cache", get_checksum_cache)
+    assert (
+        checksum_file_cached(data_file)
+        == "dffd6021bb2bd5b0af676290809ec3a53191dd81c7f70a4b28688a362182986f"
+    )
+
+
 def test_shelve_directory(setup_test_environment):
     tmp_path = setup_test_environment
 
@@ -173,6 +294,131 @@ def test_shelve_directory(setup_test_environment):
     assert (data_path / "file2.txt").exists()
 
 
+def test_reshelve_directory_in_place(setup_test_environment):
+    tmp_path = setup_test_environment
+
+    # configure test
+    path = "test_namespace/test_dataset/2024-07-26"
+    data_path = tmp_path / "data/snapshots" / path
+
+    # create dummy data
+    local_data_dir = tmp_path / "example"
+    local_data_dir.mkdir()
+    (local_data_dir / "file1.txt").write_text("Hello, World!")
+
+    # add to shelf
+    Shelf.init()
+    snapshot_to_shelf(local_data_dir, path)
+
+    # edit the snapshot in place, and re-shelve it from where it is
+    (data_path / "file2.txt").write_text("Hello, Cosmos!")
+    snapshot = snapshot_to_shelf(data_path, path, force=True)
+
+    assert snapshot.manifest == checksum_folder(data_path)
+    assert sorted(snapshot.manifest or {}) == ["file1.txt", "file2.txt"]
+
+
+def test_reshelve_file_in_place(setup_test_environment):
+    tmp_path = setup_test_environment
+
+    # configure test
+    path = "test_namespace/test_dataset/2024-07-26"
+    data_file = tmp_path / "data/snapshots" / f"{path}.txt"
+
+    # add to shelf
+    new_file = tmp_path / "file1.txt"
+    new_file.write_text("Hello, World!")
+    Shelf.init()
+    snapshot_to_shelf(new_file, path)
+
+    # edit the snapshot in place, and re-shelve it by its absolute path
+    data_file.write_text("Hello, Cosmos!")
+    snapshot = snapshot_to_shelf(data_file.resolve(), path, force=True)
+
+    assert data_file.read_text() == "Hello, Cosmos!"
+    assert (
+        snapshot.checksum
+        == "40efcea9db03adb126f27a0f339c595d1828a0713a789ea49d1ae67159d101e0"
+    )
+
+
+def test_copy_and_checksum_file_refuses_same_file(setup_test_environment):
+    data_file = setup_test_environment / "file1.txt"
+    data_file.write_text("Hello, World!")
+
+    with pytest.raises(shutil.SameFileError):
+        utils.copy_and_checksum_file(data_file, data_file.resolve())
+
+    assert data_file.read_text() == "Hello, World!"
+
+
+def test_shelve_directory_with_duplicate_files(setup_test_environment):
+    tmp_path = setup_test_environment
+
+    # configure test
+    path = "test_namespace/test_dataset/2024-07-26"
+    data_path = tmp_path / "data/snapshots" / path
+
+    # create dummy data, where two files share their contents
+    local_data_dir = tmp_path / "example"
+    (local_data_dir / "nested").mkdir(parents=True)
+    (local_data_dir / "file1.txt").write_text("Hello, World!")
+    (local_data_dir / "nested" / "file1.txt").write_text("Hello, World!")
+
+    # add to shelf
+    shelf = Shelf.init()
+    snapshot = snapshot_to_shelf(local_data_dir, path)
+    assert snapshot.manifest == checksum_folder(local_data_dir)
+
+    # both copies come back when we restore
+    shutil.rmtree(data_path)
+    plan_and_run(shelf)
+    assert (data_path / "file1.txt").read_text() == "Hello, World!"
+    assert (data_path / "nested" / "file1.txt").read_text() == "Hello, World!"
+
+
+def test_load_snapshot_is_not_shared(setup_test_environment):
+    tmp_path = setup_test_environment
+
+    # configure test
+    path = "test_namespace/test_dataset/2024-07-26"
+    metadata_file = tmp_path / "data/snapshots" / f"{path}.meta.yaml"
+    new_file = tmp_path / "file1.txt"
+    new_file.write_text("Hello, World!")
+
+    # add file to shelf, backdating its metadata so that loads can reuse it
+    Shelf.init()
+    snapshot_to_shelf(new_file, path)
+    an_hour_ago = time.time() - 3600
+    os.utime(metadata_file, (an_hour_ago, an_hour_ago))
+
+    # changes to one loaded snapshot don't leak into the next
+    snapshot = Snapshot.load(path)
+    checksum = snapshot.checksum
+    snapshot.checksum = "0" * 64
+    assert Snapshot.load(path).checksum == checksum
+
+    # but changes on disk are picked up
+    snapshot.save()
+    assert Snapshot.load(path).checksum == "0" * 64
+
+
+def test_fetch_rejects_manifest_outside_snapshot(setup_test_environment):
+    tmp_path = setup_test_environment
+
+    snapshot = Snapshot(
+        uri=StepURI.parse("snapshot://test_namespace/test_dataset/2024-07-26"),
+        snapshot_type="directory",
+        checksum="0" * 64,
+        manifest={"file1.txt": "0" * 64, "../../escaped.txt": "0" * 64},
+    )
+
+    with pytest.raises(StepDefinitionError):
+        snapshot.fetch()
+
+    assert not (tmp_path / "data/snapshots/test_namespace/escaped.txt").exists()
+
+
 def test_add_file_with_arbitrary_depth_namespace(setup_test_environment):
     tmp_path = setup_test_environment
 
@@ -358,6 +604,89 @@ def test_get_only_out_of_date_datasets(setup_test_environment):
     assert data_file2.read_text() == "Hello, Cosmos!"
 
 
+def test_failed_step_stops_its_dependents(setup_test_environment):
+    # configure test
+    broken = StepURI.parse("table://test_namespace/broken/2024-07-26")
+    downstream = StepURI.parse("table://test_namespace/downstream/2024-07-26")
+    independent = StepURI.parse("table://test_namespace/independent/2024-07-26")
+
+    # add table scripts to shelf, one of which fails
+    shelf = Shelf.init()
+    shelf.new_table(broken.path, [])
+    shelf.new_table(downstream.path, [str(broken)])
+    shelf.new_table(independent.path, [])
+    for uri, body in [
+        (broken, "sys.exit(1)"),
+        (
+            downstream,
+            'pl.DataFrame({"dim_key": ["value1"]}).write_parquet(sys.argv[-1])',
+        ),
+        (
+            independent,
+            'pl.DataFrame({"dim_key": ["value2"]}).write_parquet(sys.argv[-1])',
+        ),
+    ]:
+        script = (TABLE_SCRIPT_DIR / uri.path).with_suffix(".py")
+        script.parent.mkdir(parents=True, exist_ok=True)
+        script.write_text(
+            f"#!/usr/bin/env python3\nimport sys\nimport polars as pl\n\n{body}"
+        )
+        script.chmod(0o755)
+    shelf.refresh()
+
+    with pytest.raises(subprocess.CalledProcessError):
+        plan_and_run(shelf)
+
+    # steps that depend on the failed one never run
+    assert not (TABLE_DIR / f"{downstream.path}.parquet").exists()
+
+
+def test_failed_step_stops_queued_steps(monkeypatch):
+    dag = {
+        StepURI.parse(f"table://test_namespace/step{i}/2024-07-26"): []
+        for i in range(3)
+    }
+    executed = []
+
+    def execute_step(step, dependencies):
+        executed.append(step)
+        raise RuntimeError(f"{step} failed")
+
+    monkeypatch.setattr(steps, "execute_step", execute_step)
+
+    with pytest.raises(RuntimeError):
+        steps.execute_dag(dag, jobs=1)
+
+    # the other steps were never started
+    assert len(executed) == 1
+
+
+def test_prune_completed_skips_checks_below_dirty_steps(monkeypatch):
+    # configure test
+    snapshot = StepURI.parse("snapshot://test_namespace/test_dataset/2024-07-26")
+    table = StepURI.parse("table://test_namespace/test_table/2024-07-26")
+    downstream = StepURI.parse("table://test_namespace/downstream/2024-07-26")
+    unrelated = StepURI.parse("table://test_namespace/unrelated/2024-07-26")
+    dag = {snapshot: [], table: [snapshot], downstream: [table], unrelated: []}
+
+    # only the snapshot is out of date
+    checked = []
+
+    def is_completed(step, deps):
+        checked.append(step)
+        return step != snapshot
+
+    monkeypatch.setattr(steps, "is_completed", is_completed)
+
+    # everything below it is dirty, without being checked
+    assert steps.prune_completed(dag) == {
+        snapshot: [],
+        table: [snapshot],
+        downstream: [table],
+    }
+    assert sorted(checked) == [snapshot, unrelated]
+
+
 def test_export_duckdb(setup_test_environment):
     tmp_path = setup_test_environment
 
@@ -399,6 +728,15 @@ def test_export_duckdb(setup_test_environment):
     ).fetchall() == [("value3", "value4")]
     conn.close()
 
+    # exporting again leaves unchanged tables in place
+    export_duckdb(shelf, str(db_file))
+    conn = duckdb.connect(str(db_file))
+    assert conn.execute(
+        "SELECT * FROM test_namespace_test_table1_20240726"
+    ).fetchall() == [("value1",), ("value2",)]
+    assert conn.execute("SELECT COUNT(*) FROM _shelf_export_meta").fetchone() == (2,)
+    conn.close()
+
 
 def test_audit_can_fix_manifest_checksum(setup_test_environment):
     tmp_path = setup_test_environment
@@ -568,6 +906,37 @@ def test_resolve_latest_dependency(setup_test_environment):
     uri2_latest = StepURI.parse("snapshot://test_namespace/test_dataset2/latest")
     assert shelf.get_latest_version(uri2_latest) == uri2
 
+    # latest of nothing is an error
+    uri3_latest = StepURI.parse("table://test_namespace/test_dataset3/latest")
+    with pytest.raises(ValueError, match="No versions"):
+        shelf.get_latest_version(uri3_latest)
+
+
+def test_refresh_reuses_unchanged_shelf(setup_test_environment):
+    tmp_path = setup_test_environment
+
+    # configure test
+    uri = StepURI.parse("table://test_namespace/test_table/2024-07-26")
+    shelf_yaml_file = tmp_path / "shelf.yaml"
+
+    # backdate the shelf so that it is eligible for reuse
+    Shelf.init()
+    an_hour_ago = time.time() - 3600
+    os.utime(shelf_yaml_file, (an_hour_ago, an_hour_ago))
+    shelf = Shelf()
+
+    # in-memory edits are not seen by other shelves, and are still discarded
+    # by a refresh
+    shelf.steps[uri] = []
+    assert Shelf().steps == {}
+    shelf.refresh()
+    assert shelf.steps == {}
+
+    # and changes on disk are still picked up
+    shelf.new_table(uri.path, [])
+    shelf.refresh()
+    assert shelf.steps == {uri: []}
+
 
 def test_table_aliases_empty():
     assert _table_aliases([]) == []
@@ -1,12 +1,19 @@
 import os
 import random
 import shutil
+from pathlib import Path
 from typing import Any, Optional
 
 import polars as pl
 import pytest
+from shelf.exceptions import ValidationError
 from shelf.paths import SNAPSHOT_DIR, TABLE_DIR, TABLE_SCRIPT_DIR
-from shelf.tables import _metadata_path, build_table
+from shelf.tables import (
+    _metadata_path,
+    _simplify_dependency_names,
+    build_table,
+    is_completed,
+)
 from shelf.types import StepURI
 from shelf.utils import checksum_file, load_yaml, save_yaml
 
@@ -203,6 +210,111 @@ SELECT
     assert result_df.equals(expected_df)
 
 
+def test_is_completed_after_touching_script(setup_test_environment):
+    uri = StepURI.parse("table://dataset/latest")
+    script_path = TABLE_SCRIPT_DIR / "dataset/latest.sql"
+    script_path.parent.mkdir(parents=True, exist_ok=True)
+    script_path.write_text("SELECT 1 AS dim_col1, 2 AS col2")
+
+    build_table(uri, [])
+    assert is_completed(uri, [])
+
+    # touching the script without changing it falls back to checksums
+    built_at = _metadata_path(uri).stat().st_mtime_ns
+    later = built_at + 1_000_000_000
+    os.utime(script_path, ns=(later, later))
+    assert is_completed(uri, [])
+
+    # but a real change is still noticed
+    script_path.write_text("SELECT 3 AS dim_col1, 4 AS col2")
+    os.utime(script_path, ns=(later, later))
+    assert not is_completed(uri, [])
+
+
+def test_validation_rules_are_checked(setup_test_environment):
+    uri = StepURI.parse("table://dataset/latest")
+    script_path = TABLE_SCRIPT_DIR / "dataset/latest.sql"
+    script_path.parent.mkdir(parents=True, exist_ok=True)
+    script_path.write_text(
+        "SELECT 1 AS dim_col1, NULL AS col2 UNION ALL SELECT 1 AS dim_col1, 2 AS col2"
+    )
+    save_yaml(
+        {
+            "validation": {
+                "required_columns": ["dim_col1", "col3"],
+                "unique_columns": ["dim_col1"],
+                "not_null": ["col2"],
+            }
+        },
+        script_path.with_suffix(".meta.yaml"),
+    )
+
+    with pytest.raises(ValidationError) as e:
+        build_table(uri, [])
+
+    assert str(e.value).splitlines()[1:] == [
+        "Required column missing: col3",
+        "Column not unique: dim_col1",
+        "Column contains null values: col2",
+    ]
+    assert not (TABLE_DIR / "dataset/latest.parquet").exists()
+
+
+def test_simplify_dependency_names():
+    deps = [
+        Path("data/snapshots/a/b/2024-07-26.csv"),
+        Path("data/snapshots/a/c/2024-07-26.csv"),
+    ]
+    assert _simplify_dependency_names(deps) == {"b": deps[0], "c": deps[1]}
+
+
+def test_simplify_dependency_names_path_conflict():
+    deps = [
+        Path("data/snapshots/a/c/2024-07-26.csv"),
+        Path("data/tables/d/c/latest.parquet"),
+        Path("data/tables/e/f/latest.parquet"),
+    ]
+    assert _simplify_dependency_names(deps) == {
+        "a_c": deps[0],
+        "d_c": deps[1],
+        "f": deps[2],
+    }
+
+
+def test_simplify_dependency_names_keeps_short_names():
+    # b_c is only a longer name for the second dependency, so it doesn't
+    # stop the first from using it
+    deps = [
+        Path("data/tables/x/b_c/latest.parquet"),
+        Path("data/snapshots/b/c/2024-01-01.csv"),
+    ]
+    assert _simplify_dependency_names(deps) == {"b_c": deps[0], "c": deps[1]}
+
+
+def test_simplify_dependency_names_avoids_taken_names():
+    deps = [
+        Path("data/tables/x/b_c/latest.parquet"),
+        Path("data/snapshots/b/c/2024-01-01.csv"),
+        Path("data/snapshots/y/c/2024-01-01.csv"),
+    ]
+    assert _simplify_dependency_names(deps) == {
+        "b_c": deps[0],
+        "y_c": deps[2],
+        "snapshots_b_c": deps[1],
+    }
+
+
+def test_simplify_dependency_names_version_conflict():
+    deps = [
+        Path("data/snapshots/a/b/2024-07-26.csv"),
+        Path("data/snapshots/a/b/2024-10-03.csv"),
+    ]
+    assert _simplify_dependency_names(deps) == {
+        "b_20240726": deps[0],
+        "b_20241003": deps[1],
+    }
+
+
 def add_mock_snapshot(metadata: Optional[dict[str, Any]] = None) -> StepURI:
     # choose the uri
     uri = StepURI("snapshot", random_path())